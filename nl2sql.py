@@ -7,28 +7,143 @@ NATURAL LANGUAGE TO SQL POC WORKFLOW:
 """
 
 import os
+import re
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import logging
+import queue
+import random
 import sqlite3
-from openai import OpenAI
-from typing import Tuple, Optional, List, Dict, Any
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from logging.handlers import QueueHandler
+import numpy as np
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+from pydantic import BaseModel
+from typing import Tuple, Optional, List, Dict, Any, Awaitable, Callable, cast
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-if not client.api_key:
+# Transient failures are retried by SQLGenerator's own backoff, not the client's
+aclient = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+if not aclient.api_key:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 
+# Conservative: anything that might modify the DB bypasses and clears the result cache
+_SQL_WRITE_RE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER|ATTACH|DETACH|PRAGMA|VACUUM|REINDEX)\b",
+    re.IGNORECASE
+)
+# Reads whose result can change between runs are executed every time and never cached.
+# Date/time functions default to 'now' when called without a time value
+_SQL_VOLATILE_RE = re.compile(
+    r"\b(RANDOM|RANDOMBLOB|NOW|CURRENT_\w+|CHANGES|TOTAL_CHANGES|LAST_INSERT_ROWID)\b"
+    r"|\b(DATE|TIME|DATETIME|JULIANDAY|UNIXEPOCH)\s*\(\s*\)"
+    r"|\bSTRFTIME\s*\(\s*'(?:[^']|'')*'\s*\)",
+    re.IGNORECASE
+)
+# Quoted strings and numbers in generated SQL, for checking a semantic hit's values
+_SQL_LITERAL_RE = re.compile(r"'((?:[^']|'')*)'|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])")
+RESULT_CACHE_SIZE = 256
+MAX_CONCURRENT_REQUESTS = 8
+# Questions per batch request; at 200 output tokens each this stays well under
+# gpt-4o-mini's 16,384-token output limit
+MAX_BATCH_SIZE = 20
+MAX_BACKOFF_RETRIES = 5
+MAX_BACKOFF_SECONDS = 30
+# Errors _call_openai backs off on; once they escape it, retrying again won't help
+_TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Progress messages are queued in memory instead of written to stdout from inside
+# gathered coroutines, and printed alongside each question's results
+_current_question: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("question", default=None)
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_pending_logs: Dict[Optional[str], List[str]] = defaultdict(list)
+
+def _tag_question(record: logging.LogRecord) -> bool:
+    """Attach the question being processed to a log record"""
+    if not hasattr(record, 'question'):
+        record.question = _current_question.get()
+    return True
+
+_log_handler = QueueHandler(_log_queue)
+_log_handler.addFilter(_tag_question)
+log = logging.getLogger("nl2sql")
+log.setLevel(logging.DEBUG)
+log.addHandler(_log_handler)
+log.propagate = False
+
+def drain_log(question: Optional[str]) -> List[str]:
+    """Return queued log messages for a question, plus any not tied to one"""
+    while True:
+        try:
+            record = _log_queue.get_nowait()
+        except queue.Empty:
+            break
+        _pending_logs[record.question].append(record.getMessage())
+    messages = _pending_logs.pop(None, [])
+    if question is not None:
+        messages += _pending_logs.pop(question, [])
+    return messages
+
+def _sql_literals(sql: str) -> List[str]:
+    """Return the string and numeric literals in a SQL query, LIKE wildcards trimmed"""
+    literals = []
+    for string, number in _SQL_LITERAL_RE.findall(sql):
+        literal = number or string.replace("''", "'").strip("%_ ")
+        if literal:
+            literals.append(literal)
+    return literals
+
+def _mentions(text: str, literal: str) -> bool:
+    """Whether a literal appears in text as a whole word, ignoring case"""
+    return re.search(rf"(?<!\w){re.escape(literal)}(?!\w)", text, re.IGNORECASE) is not None
+
 class DatabaseManager:
     """Handles database setup and operations"""
     def __init__(self):
-        self.conn = sqlite3.connect(':memory:')
+        # Size sqlite3's prepared-statement cache to match the result cache. Queries run
+        # in worker threads (see aexecute_sql), and autocommit leaves no transaction
+        # open between them
+        self.conn = sqlite3.connect(
+            ':memory:',
+            cached_statements=RESULT_CACHE_SIZE,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self.conn.execute("PRAGMA cache_size=-20000")
         self._setup_database()
+        self._cursor = self.conn.cursor()
+        # Guards the shared cursor and result cache across worker threads
+        self._lock = threading.Lock()
+        # Entries are stored as tuples and copied out, so callers can't mutate cached answers
+        self._result_cache: OrderedDict[str, Tuple[Tuple[str, ...], Tuple[Any, ...]]] = OrderedDict()
+        # Column names per exact read query text, like the result cache; outlives its eviction
+        self._col_cache: Dict[str, Tuple[str, ...]] = {}
+        # Schema is fixed for the life of the process, so build it once
+        self._schema = self._load_schema()
+        self._schema_info = "\n".join(
+            f"Table {table['table']} columns: "
+            + ", ".join(f"{col} {typ}" for col, typ in zip(table['columns'], table['types']))
+            for table in self._schema
+        )
     
     def _setup_database(self):
         """Initialize database with sample schema and data"""
+        # In-memory DB has nothing to protect on disk, so skip journaling and syncs
+        self.conn.execute("PRAGMA journal_mode=MEMORY")
+        self.conn.execute("PRAGMA synchronous=OFF")
         cursor = self.conn.cursor()
+        # One transaction for DDL and seed data, committed once at the end
+        cursor.execute("BEGIN")
         
         
         create_products = """
@@ -93,22 +208,39 @@ class DatabaseManager:
             (7, 3, 5, '2023-10-07', 2),
         ]
         
-        cursor.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)", products)
-        cursor.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", users)
-        cursor.executemany("INSERT INTO purchases VALUES (?, ?, ?, ?, ?)", purchases)
+        self._insert_rows(cursor, "products", products)
+        self._insert_rows(cursor, "users", users)
+        self._insert_rows(cursor, "purchases", purchases)
         self.conn.commit()
 
+    @staticmethod
+    def _insert_rows(cursor: sqlite3.Cursor, table: str, rows: List[Tuple]):
+        """Insert all rows with a single multi-row INSERT statement"""
+        placeholders = "(" + ", ".join("?" * len(rows[0])) + ")"
+        cursor.execute(
+            f"INSERT INTO {table} VALUES " + ", ".join([placeholders] * len(rows)),
+            list(itertools.chain.from_iterable(rows))
+        )
+
     def get_schema(self) -> List[Dict[str, Any]]:
+        """Return the cached database schema"""
+        return self._schema
+
+    def _load_schema(self) -> List[Dict[str, Any]]:
         """Retrieve database schema information"""
         cursor = self.conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = cursor.fetchall()
+        # One query for every table's columns instead of a PRAGMA per table
+        cursor.execute("""
+            SELECT m.name, p.name, p.type
+            FROM sqlite_master m
+            JOIN pragma_table_info(m.name) p
+            WHERE m.type = 'table'
+            ORDER BY m.rowid, p.cid
+        """)
         
         schema = []
-        for table in tables:
-            table_name = table[0]
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = cursor.fetchall()
+        for table_name, columns in itertools.groupby(cursor.fetchall(), key=lambda row: row[0]):
+            columns = list(columns)
             schema.append({
                 'table': table_name,
                 'columns': [col[1] for col in columns],
@@ -116,34 +248,208 @@ class DatabaseManager:
             })
         return schema
     
+    async def aexecute_sql(self, sql: str) -> Tuple[bool, Optional[Tuple[List[str], List[Any]]], Optional[str]]:
+        """Execute SQL query in a worker thread so the event loop keeps serving OpenAI calls"""
+        return await asyncio.to_thread(self.execute_sql, sql)
+    
     def execute_sql(self, sql: str) -> Tuple[bool, Optional[Tuple[List[str], List[Any]]], Optional[str]]:
         """Execute SQL query and return results"""
+        with self._lock:
+            return self._execute_sql(sql)
+    
+    def _execute_sql(self, sql: str) -> Tuple[bool, Optional[Tuple[List[str], List[Any]]], Optional[str]]:
+        """Execute SQL query and return results; caller must hold the lock"""
+        # Keyed on the exact text: whitespace can end a -- comment, and SQLite names
+        # expression columns after their literal spelling
+        key = sql.strip()
+        is_write = _SQL_WRITE_RE.search(key) is not None
+        cacheable = not is_write and _SQL_VOLATILE_RE.search(key) is None
+        if cacheable and key in self._result_cache:
+            self._result_cache.move_to_end(key)
+            columns, results = self._result_cache[key]
+            return True, (list(columns), list(results)), None
+        
         try:
-            cursor = self.conn.cursor()
+            cursor = self._cursor
             cursor.execute(sql)
             results = cursor.fetchall()
-            columns = [description[0] for description in cursor.description] if cursor.description else []
-            return True, (columns, results), None
+            cached_columns = self._col_cache.get(key) if cacheable else None
+            if cached_columns is not None:
+                columns = list(cached_columns)
+            else:
+                columns = [description[0] for description in cursor.description] if cursor.description else []
         except Exception as e:
             return False, None, str(e)
+        
+        if is_write:
+            # A write may have been DDL that changes column lists
+            self._result_cache.clear()
+            self._col_cache.clear()
+        elif cacheable:
+            self._result_cache[key] = (tuple(columns), tuple(results))
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+            if key not in self._col_cache:
+                if len(self._col_cache) >= RESULT_CACHE_SIZE:
+                    del self._col_cache[next(iter(self._col_cache))]
+                self._col_cache[key] = tuple(columns)
+        return True, (columns, results), None
+
+class SemanticCache:
+    """Caches generated SQL by question embedding, matching close paraphrases"""
+    def __init__(self, threshold: float = 0.92, ttl: float = 3600.0):
+        self.threshold = threshold
+        self.ttl = ttl
+        self._embeddings: List[np.ndarray] = []
+        self._sqls: List[str] = []
+        self._literals: List[List[str]] = []
+        self._timestamps: List[float] = []
+
+    def lookup(self, embedding: np.ndarray, question: str) -> Optional[str]:
+        """Return cached SQL for the most similar stored question above the threshold"""
+        self._evict_expired()
+        if not self._embeddings:
+            return None
+        # Embeddings are unit-normalized, so one matrix-vector product gives cosine similarity
+        similarities = np.vstack(self._embeddings) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        # "...in Bangalore" and "...in Mumbai" embed close together, but the SQL
+        # answers only the one whose values it carries
+        if not all(_mentions(question, literal) for literal in self._literals[best]):
+            return None
+        return self._sqls[best]
+
+    def add(self, embedding: np.ndarray, question: str, sql: str):
+        """Store SQL that executed successfully for an embedded question, if it only reads"""
+        # Paraphrases are answered by re-running the SQL, so a write would
+        # repeat the first question's values
+        if _SQL_WRITE_RE.search(sql) is not None:
+            return
+        self._embeddings.append(embedding)
+        self._sqls.append(sql)
+        # Only values taken from the question must match a later one; the rest
+        # (LIMIT 1, > 0, ...) come from the query's shape
+        self._literals.append([
+            literal for literal in _sql_literals(sql) if _mentions(question, literal)
+        ])
+        self._timestamps.append(time.monotonic())
+
+    def _evict_expired(self):
+        """Drop semantic entries older than the TTL"""
+        cutoff = time.monotonic() - self.ttl
+        # Timestamps are appended in order, so expired entries form a prefix
+        expired = 0
+        while expired < len(self._timestamps) and self._timestamps[expired] < cutoff:
+            expired += 1
+        if expired:
+            del self._embeddings[:expired]
+            del self._sqls[:expired]
+            del self._literals[:expired]
+            del self._timestamps[:expired]
+
+class SQLOut(BaseModel):
+    """Structured output schema for a generated query"""
+    sql: str
+
+class SQLBatchItem(BaseModel):
+    """Generated query for one question of a batch"""
+    idx: int
+    sql: str
+
+class SQLBatchOut(BaseModel):
+    """Structured output schema for a batch of generated queries"""
+    results: List[SQLBatchItem]
 
 class SQLGenerator:
    
     def __init__(self, db: DatabaseManager):
         self.db = db
+        self.cache = SemanticCache()
+        # Caps in-flight completion requests so gathered questions don't burst past rate limits
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # Generation is deterministic (temperature=0), so a literal repeat of
+        # (question, schema) always maps to the same SQL
+        self._sql_cache: Dict[str, str] = {}
+        # Static content only, so every request shares an identical prefix
+        # that OpenAI's automatic prompt caching can reuse
+        self._instructions = (
+            "You are a SQL expert that converts questions to accurate SQL queries.\n"
+            "Convert each natural language question into a SQL query for SQLite.\n"
+            "If a previous error is given, correct the SQL query so it no longer fails.\n"
+            "Put ONLY the SQL query in the sql field, with no explanation or markdown formatting."
+        )
+        self._schema_prompt = f"Database schema:\n{db._schema_info}"
+        self._system_prompt = f"{self._instructions}\n\n{self._schema_prompt}"
+        # Server-side conversation for chained follow-up questions (Responses API)
+        self._last_response_id: Optional[str] = None
     
-    def generate_sql(self, question: str, max_retries: int = 3) -> Dict[str, Any]:
+    async def agenerate_sql(self, question: str, max_retries: int = 3, chained: bool = False) -> Dict[str, Any]:
         """Generate and execute SQL with error correction"""
-        retry_count = 0
-        last_error = None
+        _current_question.set(question)
+        # Chained questions continue the previous chained question's conversation and
+        # may refer back to it, so their SQL is neither looked up in nor stored in the caches
+        key = self._cache_key(question)
+        cached_sql = None if chained else self._sql_cache.get(key)
+        embedding = None
+        # First-attempt generation started alongside the embedding lookup, so a
+        # semantic-cache miss doesn't pay for the embedding round trip first
+        speculative: Optional[asyncio.Task] = None
+        if cached_sql is None and not chained:
+            embed_task = asyncio.create_task(self._embed(question))
+            speculative = asyncio.create_task(self._generate_with_openai(question, False, None))
+            # Retrieve the outcome if the task is discarded, so a failure isn't reported as unhandled
+            speculative.add_done_callback(lambda task: task.cancelled() or task.exception())
+            try:
+                embedding = await embed_task
+                cached_sql = self.cache.lookup(embedding, question)
+            except Exception as e:
+                log.debug("Embedding error: %s", e)
+        
+        if cached_sql is not None:
+            success, results, error = await self.db.aexecute_sql(cached_sql)
+            if success:
+                if speculative is not None:
+                    speculative.cancel()
+                return {
+                    'success': True,
+                    'sql': cached_sql,
+                    'results': results,
+                    'attempts': 0,
+                    'cached': True
+                }
+            log.debug("Cached SQL failed, regenerating: %s", error)
+        
+        return await self._generate_uncached(question, key, embedding, max_retries, chained, speculative=speculative)
+    
+    async def _generate_uncached(self, question: str, key: str, embedding: Optional[np.ndarray], max_retries: int,
+                                 chained: bool = False, sql_error: Optional[str] = None,
+                                 speculative: Optional[asyncio.Task] = None) -> Dict[str, Any]:
+        """Run the generate/execute retry loop for a question that missed the caches"""
+        _current_question.set(question)
+        # A failed batch attempt (sql_error) counts as the first attempt
+        retry_count = 0 if sql_error is None else 1
+        last_error = sql_error
+        # Only SQL execution errors (sql_error) are fed back into the prompt;
+        # generation failures are retried with the prompt unchanged
         
         while retry_count <= max_retries:
             try:
-                sql = self._generate_with_openai(question, retry_count > 0, last_error)
-                print(f"Attempt {retry_count + 1}: Generated SQL:\n{sql}\n")
-                success, results, error = self.db.execute_sql(sql)
+                if speculative is not None:
+                    task, speculative = speculative, None
+                    sql = await task
+                else:
+                    generate = self._generate_with_responses if chained else self._generate_with_openai
+                    sql = await generate(question, sql_error is not None, sql_error)
+                log.debug("Attempt %d: Generated SQL:\n%s", retry_count + 1, sql)
+                success, results, error = await self.db.aexecute_sql(sql)
                 
                 if success:
+                    if not chained:
+                        self._sql_cache[key] = sql
+                    if embedding is not None:
+                        self.cache.add(embedding, question, sql)
                     return {
                         'success': True,
                         'sql': sql,
@@ -151,12 +457,20 @@ class SQLGenerator:
                         'attempts': retry_count + 1
                     }
                 else:
-                    last_error = error
-                    print(f"Execution error: {error}\n")
+                    last_error = sql_error = error
+                    log.debug("Execution error: %s", error)
                     retry_count += 1
+            except _TRANSIENT_ERRORS as e:
+                # _call_openai already backed off on this, so another round would only stack retries
+                log.debug("Generation error: %s", e)
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'attempts': retry_count + 1
+                }
             except Exception as e:
                 last_error = str(e)
-                print(f"Generation error: {last_error}\n")
+                log.debug("Generation error: %s", last_error)
                 retry_count += 1
         
         return {
@@ -165,56 +479,254 @@ class SQLGenerator:
             'attempts': retry_count
         }
     
-    def _generate_with_openai(self, question: str, is_retry: bool, last_error: Optional[str]) -> str:
-        """Generate SQL using OpenAI API"""
-        schema = self.db.get_schema()
-        schema_info = "\n".join([
-            f"Table {table['table']} columns: {', '.join(table['columns'])}"
-            for table in schema
+    async def agenerate_sql_batch(self, questions: List[str], max_retries: int = 3) -> List[Dict[str, Any]]:
+        """Generate SQL for several questions in one request, falling back per question on failure"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+        keys = [self._cache_key(question) for question in questions]
+        pending = [i for i, key in enumerate(keys) if key not in self._sql_cache]
+        
+        # Embed every uncached question in one request and answer paraphrases from the
+        # semantic cache, with generation for all of them started alongside so a miss
+        # doesn't wait for the embedding round trip first
+        embeddings: Dict[int, np.ndarray] = {}
+        speculative: Optional[asyncio.Future] = None
+        # Positions in pending covered by each generation request
+        chunks: List[range] = []
+        if pending:
+            embed_task = asyncio.create_task(self._embed_many([questions[i] for i in pending]))
+            if len(pending) > 1:
+                chunks = [range(start, min(start + MAX_BATCH_SIZE, len(pending)))
+                          for start in range(0, len(pending), MAX_BATCH_SIZE)]
+                requests = [self._generate_batch_with_openai([questions[pending[pos]] for pos in chunk])
+                            for chunk in chunks]
+            else:
+                chunks = [range(1)]
+                requests = [self._generate_with_openai(questions[pending[0]], False, None)]
+            # Failures come back as values, so one chunk's error doesn't discard the others' SQL
+            speculative = asyncio.gather(*requests, return_exceptions=True)
+            try:
+                embedded = await embed_task
+                embeddings = dict(zip(pending, embedded))
+            except Exception as e:
+                log.debug("Embedding error: %s", e)
+        for i, embedding in embeddings.items():
+            cached_sql = self.cache.lookup(embedding, questions[i])
+            if cached_sql is None:
+                continue
+            success, rows, error = await self.db.aexecute_sql(cached_sql)
+            if success:
+                results[i] = {
+                    'success': True,
+                    'sql': cached_sql,
+                    'results': rows,
+                    'attempts': 0,
+                    'cached': True
+                }
+            else:
+                log.debug("Cached SQL failed, regenerating: %s", error, extra={'question': questions[i]})
+        
+        # Generated SQL keyed by position in the pending list it was requested for
+        batch_sql: Dict[int, str] = {}
+        if speculative is not None:
+            if all(results[i] is not None for i in pending):
+                speculative.cancel()
+            else:
+                for chunk, generated in zip(chunks, await speculative):
+                    if isinstance(generated, _TRANSIENT_ERRORS):
+                        # Backoff is already exhausted; per-question fallbacks would hit the same wall
+                        log.debug("Batch generation error: %s", generated)
+                        for pos in chunk:
+                            if results[pending[pos]] is None:
+                                results[pending[pos]] = {
+                                    'success': False,
+                                    'error': str(generated),
+                                    'attempts': 1
+                                }
+                    elif isinstance(generated, BaseException):
+                        log.debug("Batch generation error: %s", generated)
+                    elif isinstance(generated, dict):
+                        batch_sql.update((chunk[idx], sql) for idx, sql in generated.items())
+                    else:
+                        batch_sql[chunk[0]] = generated
+        
+        # Execution errors are carried into each question's fallback so its first
+        # attempt corrects the batch SQL instead of regenerating it from scratch
+        batch_errors: Dict[int, str] = {}
+        for pos, i in enumerate(pending):
+            sql = batch_sql.get(pos)
+            # Semantic-cache hits already have their answer
+            if sql is None or results[i] is not None:
+                continue
+            log.debug("Batch: Generated SQL:\n%s", sql, extra={'question': questions[i]})
+            success, rows, error = await self.db.aexecute_sql(sql)
+            if success:
+                self._sql_cache[keys[i]] = sql
+                if i in embeddings:
+                    self.cache.add(embeddings[i], questions[i], sql)
+                results[i] = {
+                    'success': True,
+                    'sql': sql,
+                    'results': rows,
+                    'attempts': 1
+                }
+            else:
+                log.debug("Batch execution error: %s", error, extra={'question': questions[i]})
+                batch_errors[i] = f"{error}\nFailed SQL: {sql}"
+        
+        # Exact-cache hits go through agenerate_sql; questions the batch could not answer
+        # already missed both caches, so they go straight to the retry loop
+        fallback = [i for i, result in enumerate(results) if result is None]
+        fallback_results = await asyncio.gather(*[
+            self._generate_uncached(questions[i], keys[i], embeddings.get(i), max_retries,
+                                    sql_error=batch_errors.get(i))
+            if i in pending else self.agenerate_sql(questions[i], max_retries)
+            for i in fallback
         ])
+        for i, result in zip(fallback, fallback_results):
+            results[i] = result
+        return cast(List[Dict[str, Any]], results)
+    
+    async def _call_openai(self, request: Callable[[], Awaitable[Any]], limited: bool = True) -> Any:
+        """Run an OpenAI request under the concurrency cap, backing off on transient errors"""
+        for attempt in range(MAX_BACKOFF_RETRIES + 1):
+            try:
+                async with self._sem if limited else contextlib.nullcontext():
+                    return await request()
+            # APIConnectionError covers timeouts too; InternalServerError is any HTTP 5xx
+            except _TRANSIENT_ERRORS as e:
+                # An exhausted quota is also a 429, but waiting won't restore it
+                if attempt == MAX_BACKOFF_RETRIES or getattr(e, 'code', None) == "insufficient_quota":
+                    raise
+                # Sleep outside the semaphore so other questions can use the slot
+                delay = self._retry_after(e)
+                if delay is None:
+                    delay = 2 ** attempt + random.random()
+                delay = min(delay, MAX_BACKOFF_SECONDS)
+                log.debug("%s, retrying in %.1fs", type(e).__name__, delay)
+                await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """Return the server's requested Retry-After delay in seconds, if it sent one"""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        try:
+            return max(float(response.headers.get("retry-after")), 0.0)
+        except (TypeError, ValueError):
+            # Missing, or an HTTP date rather than a number of seconds
+            return None
+    
+    def _cache_key(self, question: str) -> str:
+        """Return the exact-match cache key for a question against the current schema"""
+        return hashlib.sha256(f"{question}|{self.db._schema_info}".encode()).hexdigest()
+    
+    async def _embed(self, question: str) -> np.ndarray:
+        """Return the unit-normalized embedding of a question"""
+        return (await self._embed_many([question]))[0]
+    
+    async def _embed_many(self, questions: List[str]) -> List[np.ndarray]:
+        """Return unit-normalized embeddings for several questions from one request"""
+        # Embeddings skip the completion concurrency cap: they have their own rate limit,
+        # and a lookup queued behind speculative completions would finish too late to help
+        response = await self._call_openai(lambda: aclient.embeddings.create(
+            model="text-embedding-3-small",
+            input=questions
+        ), limited=False)
+        embeddings = []
+        for item in sorted(response.data, key=lambda item: item.index):
+            embedding = np.asarray(item.embedding, dtype=np.float32)
+            embeddings.append(embedding / np.linalg.norm(embedding))
+        return embeddings
+    
+    async def _generate_with_openai(self, question: str, is_retry: bool, last_error: Optional[str]) -> str:
+        """Generate SQL using OpenAI API"""
+        prompt = f"Question: {question}"
+        if is_retry and last_error:
+            prompt += f"\nPrevious error: {last_error}"
         
+        response = await self._call_openai(lambda: aclient.chat.completions.parse(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": self._system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            max_tokens=200,
+            response_format=SQLOut
+        ))
+        
+        message = response.choices[0].message
+        if message.parsed is None:
+            raise ValueError(message.refusal or "Model returned no SQL")
+        return message.parsed.sql.strip()
+
+    async def _generate_with_responses(self, question: str, is_retry: bool, last_error: Optional[str]) -> str:
+        """Generate SQL as the next turn of a server-side Responses API conversation"""
+        prompt = f"Question: {question}"
         if is_retry and last_error:
-            prompt = f"""
-            The previous SQL query failed with error: {last_error}
-            Please correct the SQL query for this question: {question}
-            Database schema:
-            {schema_info}
-            
-            Return ONLY the SQL query with no additional explanation or formatting.
-            """
+            prompt += f"\nPrevious error: {last_error}"
+        
+        # Instructions are not carried over by previous_response_id, but the schema
+        # only needs to be sent on the first turn; later turns send just the question
+        if self._last_response_id is None:
+            turn = [
+                {"role": "developer", "content": self._schema_prompt},
+                {"role": "user", "content": prompt}
+            ]
         else:
-            prompt = f"""
-            Convert this natural language question into a SQL query for SQLite:
-            Question: {question}
-            Database schema:
-            {schema_info}
-            
-            Return ONLY the SQL query with no additional explanation or formatting.
-            """
+            turn = [{"role": "user", "content": prompt}]
         
-        response = client.chat.completions.create(
+        response = await self._call_openai(lambda: aclient.responses.parse(
+            model="gpt-4o-mini",
+            instructions=self._instructions,
+            input=turn,
+            previous_response_id=self._last_response_id,
+            temperature=0,
+            max_output_tokens=200,
+            text_format=SQLOut
+        ))
+        self._last_response_id = response.id
+        
+        if response.output_parsed is None:
+            raise ValueError("Model returned no SQL")
+        return response.output_parsed.sql.strip()
+
+    async def _generate_batch_with_openai(self, questions: List[str]) -> Dict[int, str]:
+        """Generate SQL for several questions with one OpenAI call, keyed by question index"""
+        prompt = "Answer each question below, returning one result per question with its idx.\n"
+        prompt += "\n".join(f"Question {idx}: {question}" for idx, question in enumerate(questions))
+        
+        response = await self._call_openai(lambda: aclient.chat.completions.parse(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "You are a SQL expert that converts questions to accurate SQL queries."},
+                {"role": "system", "content": self._system_prompt},
                 {"role": "user", "content": prompt}
             ],
             temperature=0,
-            max_tokens=200
-        )
+            max_tokens=200 * len(questions),
+            response_format=SQLBatchOut
+        ))
         
-        sql = response.choices[0].message.content.strip()
-        
-     
-        for prefix in ["```sql", "```"]:
-            if sql.startswith(prefix):
-                sql = sql[len(prefix):].split("```")[0].strip()
-        return sql
+        message = response.choices[0].message
+        if message.parsed is None:
+            raise ValueError(message.refusal or "Model returned no SQL")
+        return {
+            item.idx: item.sql.strip()
+            for item in message.parsed.results
+            if 0 <= item.idx < len(questions)
+        }
 
-def display_results(result: Dict[str, Any]):
+def display_results(result: Dict[str, Any], question: Optional[str] = None):
   
+    for message in drain_log(question):
+        print(f"{message}\n")
     print(f"\n{'='*50}")
     if result['success']:
-        print(f"SUCCESS after {result['attempts']} attempts")
+        if result.get('cached'):
+            print("SUCCESS from cache")
+        else:
+            print(f"SUCCESS after {result['attempts']} attempts")
         print("Generated SQL:")
         print(result['sql'])
         
@@ -227,22 +739,42 @@ def display_results(result: Dict[str, Any]):
         print("FAILED after maximum retries")
         print(f"Last error: {result['error']}")
 
+async def run_questions(generator: SQLGenerator, questions: List[str]) -> List[Dict[str, Any]]:
+    """Send all questions in one batched request, retrying leftovers concurrently"""
+    return await generator.agenerate_sql_batch(questions)
+
+async def run_interactive(generator: SQLGenerator):
+    """Answer questions typed at a prompt, letting each one follow up on the last"""
+    while True:
+        try:
+            question = (await asyncio.to_thread(input, "\nQuestion (blank to quit): ")).strip()
+        except EOFError:
+            break
+        if not question:
+            break
+        display_results(await generator.agenerate_sql(question, chained=True), question)
+
 def main():
  
     try:
         db = DatabaseManager()
         generator = SQLGenerator(db)
         
+        if "--interactive" in sys.argv[1:]:
+            asyncio.run(run_interactive(generator))
+            return
+        
         # test questions 
         questions = [
             "List users who spent more than 1000 in Bangalore",
             
         ]
         
-        for question in questions:
-            print(f"\nProcessing question: {question}")
-            result = generator.generate_sql(question)
-            display_results(result)
+        print(f"\nProcessing {len(questions)} question(s)")
+        results = asyncio.run(run_questions(generator, questions))
+        for question, result in zip(questions, results):
+            print(f"\nQuestion: {question}")
+            display_results(result, question)
     
     except Exception as e:
         print(f"Fatal error: {str(e)}")